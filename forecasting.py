@@ -0,0 +1,232 @@
+"""
+Next-month spending forecasts per category.
+
+All (user, category) series are fitted at once with NumPy: a least-squares
+linear trend over the last FORECAST_MONTHS months, plus a seasonal
+adjustment (average residual for the same calendar month in earlier years)
+once a user has SEASONAL_MIN_MONTHS of history. With only two months of data
+this is the same as the old `last + (last - prev)` rule.
+
+Run `python forecasting.py` (e.g. nightly) to precompute forecasts for every
+user into the `forecasts` collection (it runs migrate_expenses.py first). The /analytics/predictions endpoint then
+only has to look one up. A user's stored forecast is dropped whenever their
+expenses change, and is recomputed the next time it's requested.
+
+Each forecast doc carries a `version` that every expense change bumps. A
+forecast is only stored if the version is still the one read before the data
+was loaded, so a write landing mid-computation can't be overwritten by a stale result.
+"""
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+import certifi
+from dotenv import load_dotenv
+
+import migrate_expenses
+
+
+load_dotenv()  # Load from .env file
+
+MONGO_URI = os.getenv("MONGO_URI")
+
+client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
+db = client["expense_tracker"]
+expenses = db["expenses"]
+forecasts = db["forecasts"]
+
+forecasts.create_index("email", unique=True)
+
+FORECAST_MONTHS = 24
+SEASONAL_MIN_MONTHS = 24
+CHUNK_SIZE = 500  # users per batch query
+
+
+def month_matrix(monthly):
+    """
+    monthly: DataFrame with email, category, month (Period[M]) and amount columns.
+    Each user's series is aligned to end at their own latest month, so column
+    FORECAST_MONTHS - 1 is always "last month" and the target is column FORECAST_MONTHS.
+    Returns the (email, category) index, the amounts matrix and each row's first active column.
+    """
+    n = FORECAST_MONTHS
+    monthly = monthly.copy()
+    monthly["ord"] = pd.PeriodIndex(monthly["month"], freq="M").asi8
+    latest = monthly.groupby("email")["ord"].transform("max")
+    monthly["col"] = n - 1 - (latest - monthly["ord"])
+    monthly = monthly[monthly["col"] >= 0]
+
+    # A user's history starts at their first month in the window, for every category
+    first = monthly.groupby("email")["col"].min()
+
+    pivot = monthly.pivot_table(index=["email", "category"], columns="col", values="amount", aggfunc="sum", fill_value=0)
+    pivot = pivot.reindex(columns=range(n), fill_value=0).astype(float)
+    first_col = first.reindex(pivot.index.get_level_values("email")).to_numpy()
+    return pivot.index, pivot.to_numpy(), first_col
+
+
+def fit_forecast(Y, first_col):
+    """Vectorized trend + seasonality fit over every row of Y. Returns (predicted, actual)."""
+    rows, n = Y.shape
+    x = np.arange(n, dtype=float)
+    mask = (x[None, :] >= first_col[:, None]).astype(float)
+    active = mask.sum(axis=1)
+
+    # Per-row weighted least squares (weights = months the user has data for)
+    safe_active = np.maximum(active, 1)
+    x_mean = (mask * x).sum(axis=1) / safe_active
+    y_mean = (mask * Y).sum(axis=1) / safe_active
+    dx = (x[None, :] - x_mean[:, None]) * mask
+    denom = (dx ** 2).sum(axis=1)
+    slope = np.divide((dx * (Y - y_mean[:, None])).sum(axis=1), denom, out=np.zeros(rows), where=denom > 0)
+    intercept = y_mean - slope * x_mean
+
+    predicted = intercept + slope * n
+
+    # Seasonality: same calendar month as the target in earlier years
+    seasonal_cols = np.arange(n - 12, -1, -12)
+    if n >= SEASONAL_MIN_MONTHS and len(seasonal_cols):
+        residuals = (Y - (intercept[:, None] + slope[:, None] * x[None, :])) * mask
+        has_seasons = active >= SEASONAL_MIN_MONTHS
+        season_mask = mask[:, seasonal_cols]
+        season_count = season_mask.sum(axis=1)
+        seasonal = np.divide(residuals[:, seasonal_cols].sum(axis=1), season_count,
+                             out=np.zeros(rows), where=season_count > 0)
+        predicted = predicted + np.where(has_seasons, seasonal, 0.0)
+
+    actual = Y[:, -1]
+    # Same rule as before: need at least two months to say anything
+    predicted = np.where(active >= 2, predicted, np.nan)
+    return predicted, actual
+
+
+def _predictions_by_user(index, predicted, actual, recent):
+    """
+    Only categories with spend in the last two months are reported (the same set
+    the old two-month rule returned), and spending is never forecast below zero.
+    """
+    by_user = {}
+    for (email, category), p, a, r in zip(index, predicted, actual, recent):
+        by_user.setdefault(email, [])
+        if np.isnan(p) or r <= 0:
+            continue
+        by_user[email].append({"category": category, "actual": round(float(a), 2), "predicted": round(max(float(p), 0.0), 2)})
+    return by_user
+
+
+def _forecast_matrix(index, Y, first_col):
+    predicted, actual = fit_forecast(Y, first_col)
+    return _predictions_by_user(index, predicted, actual, Y[:, -2:].sum(axis=1))
+
+
+def forecast_from_df(df):
+    """On-demand forecast for one user from a get_expenses_df() frame."""
+    df = df.dropna(subset=["Date", "Amount"])
+    df = df[df["Amount"] > 0]
+    if df.empty:
+        return []
+
+    monthly = pd.DataFrame({
+        "email": "",
+        "category": df["Category"].fillna("Other"),
+        "month": df["Date"].dt.to_period("M"),
+        "amount": df["Amount"].astype(float),
+    })
+    return _forecast_matrix(*month_matrix(monthly)).get("", [])
+
+
+def _monthly_totals(emails):
+    """One aggregation over the chunk's expenses: totals per user, category and month."""
+    pipeline = [
+        {"$match": {"email": {"$in": emails}, "date": {"$type": "date"}}},
+        {"$project": {
+            "email": 1,
+            "category": {"$ifNull": ["$category", "Other"]},
+            "month": {"$dateToString": {"format": "%Y-%m", "date": "$date"}},
+            "amount": {"$convert": {"input": "$amount", "to": "double", "onError": None, "onNull": None}},
+        }},
+        {"$match": {"amount": {"$gt": 0}}},
+        {"$group": {
+            "_id": {"email": "$email", "category": "$category", "month": "$month"},
+            "amount": {"$sum": "$amount"},
+        }},
+    ]
+    rows = [{**r["_id"], "amount": r["amount"]} for r in expenses.aggregate(pipeline)]
+    if not rows:
+        return pd.DataFrame(columns=["email", "category", "month", "amount"])
+    monthly = pd.DataFrame(rows)
+    monthly["month"] = pd.PeriodIndex(monthly["month"], freq="M")
+    return monthly
+
+
+def _store_update(email, version, predictions, generated_at):
+    """
+    (filter, update) for an upsert that only lands if nobody bumped the version since
+    we read it; otherwise the filter misses and the upsert hits the unique email index.
+    """
+    version_filter = {"$exists": False} if version is None else version
+    return (
+        {"email": email, "version": version_filter},
+        {"$set": {"version": version or 0, "generated_at": generated_at, "predictions": predictions}},
+    )
+
+
+def store_forecast(email, predictions, version):
+    try:
+        forecasts.update_one(*_store_update(email, version, predictions, datetime.utcnow()), upsert=True)
+    except DuplicateKeyError:
+        pass  # expenses changed while we were computing; leave it for the next request
+
+
+def get_forecast(email):
+    """Returns (stored predictions or None, version to pass back to store_forecast)."""
+    doc = forecasts.find_one({"email": email}, {"_id": 0, "predictions": 1, "version": 1})
+    if not doc:
+        return None, None
+    return doc.get("predictions"), doc.get("version", 0)
+
+
+def invalidate(email):
+    if email:
+        forecasts.update_one(
+            {"email": email},
+            {"$inc": {"version": 1}, "$unset": {"predictions": ""}},
+            upsert=True
+        )
+
+
+def precompute_all(chunk_size=CHUNK_SIZE):
+    # The aggregation only sees Date-typed dates, while the on-demand path parses
+    # legacy strings; migrating first keeps both paths on the same data
+    migrate_expenses.migrate_dates()
+    migrate_expenses.migrate_amounts()
+
+    emails = [e for e in expenses.distinct("email") if e]
+    done = 0
+    for start in range(0, len(emails), chunk_size):
+        chunk = emails[start:start + chunk_size]
+        # Versions are read before the data, so users written to meanwhile are skipped
+        versions = {d["email"]: d.get("version", 0) for d in forecasts.find({"email": {"$in": chunk}}, {"email": 1, "version": 1})}
+        monthly = _monthly_totals(chunk)
+        by_user = {}
+        if not monthly.empty:
+            by_user = _forecast_matrix(*month_matrix(monthly))
+
+        now = datetime.utcnow()
+        try:
+            forecasts.bulk_write([
+                UpdateOne(*_store_update(email, versions.get(email), by_user.get(email, []), now), upsert=True)
+                for email in chunk
+            ], ordered=False)
+        except BulkWriteError as e:
+            if any(err.get("code") != 11000 for err in e.details.get("writeErrors", [])):
+                raise
+        done += len(chunk)
+        print(f"📈 Forecasts stored for {done}/{len(emails)} users")
+    return done
+
+
+if __name__ == "__main__":
+    precompute_all()
@@ -13,7 +13,7 @@ import os
 import joblib
 from datetime import datetime
 import random
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.encoders import jsonable_encoder
 from fastapi import HTTPException
 from bson.objectid import ObjectId
@@ -29,9 +29,17 @@ model = joblib.load("classifier.pkl")
 
 from routes import analytics
 from routes import auth
+from routes import events
+import spending_stats
+import forecasting
 
 import certifi
-from pymongo import MongoClient
+from pymongo import MongoClient, InsertOne, UpdateOne, DeleteOne, ReturnDocument
+from pymongo.errors import BulkWriteError
+from bson.errors import InvalidId
+import pyarrow as pa
+import pyarrow.parquet as pq
+from pymongoarrow.api import find_arrow_all
 
 
 import os
@@ -56,6 +64,7 @@ def serialize_expense(exp):
 app = FastAPI()
 app.include_router(analytics.router)
 app.include_router(auth.router)
+app.include_router(events.router)
 
 
 UPLOAD_DIR = "uploads"
@@ -69,6 +78,11 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Anything derived from a user's expenses is stale now: drop the stored forecast and tell open dashboards
+def expenses_changed(email, source):
+    forecasting.invalidate(email)
+    events.broker.publish(email, {"type": "expenses_changed", "source": source})
+
 # Helper to save to unified CSV
 def append_to_expense_log(date, desc, amount, category, email=None):
     # CSV Logging (optional)
@@ -86,6 +100,7 @@ def append_to_expense_log(date, desc, amount, category, email=None):
         "email": email  # ✅ NEW
     }
     collection.insert_one(mongo_doc)
+    return mongo_doc
 
 @app.get("/")
 def root():
@@ -143,17 +158,25 @@ async def upload_csv(file: UploadFile = File(...), email: str = Form(...)):
         df = df.dropna(subset=["Date", "Description", "Amount"])
         df["Category"] = df["Description"].apply(categorize_text)
 
+        # Build stats for older users before their new rows land, so they aren't counted twice
+        spending_stats.ensure_user_stats(email)
+
+        docs = []
         for _, row in df.iterrows():
             formatted_date = row["Date"].strftime("%Y-%m-%d")
-            append_to_expense_log(
+            docs.append(append_to_expense_log(
                 date=formatted_date,
                 desc=row["Description"],
                 amount=row["Amount"],
                 category=row["Category"],
                 email=email  # ✅ Pass email
-            )
+            ))
 
-        return {"message": f"{len(df)} entries uploaded and categorized successfully."}
+        anomalies = [flag for flag in spending_stats.check_transactions(docs) if flag]
+        spending_stats.record_changes([(doc, 1) for doc in docs])
+        expenses_changed(email, "upload_csv")
+
+        return {"message": f"{len(df)} entries uploaded and categorized successfully.", "anomalies": anomalies}
 
     except Exception as e:
         return {"error": str(e)}
@@ -194,14 +217,22 @@ async def upload_receipt(file: UploadFile = File(...), email: str = Form(...)):
 
         receipt_date = date if date else "Unknown"
 
+        spending_stats.ensure_user_stats(email)
+
+        docs = []
         for item in items:
-            append_to_expense_log(
+            docs.append(append_to_expense_log(
                 date=receipt_date,
                 desc=item['name'],
                 amount=item['price'],
                 category=item['category'],
                 email=email  # ✅ Pass email
-            )
+            ))
+
+        for item, flag in zip(items, spending_stats.check_transactions(docs)):
+            item["anomaly"] = flag
+        spending_stats.record_changes([(doc, 1) for doc in docs])
+        expenses_changed(email, "upload_receipt")
 
         return {
             "message": "Receipt processed successfully.",
@@ -297,15 +328,34 @@ def serialize_expense(expense):
     return expense
 
 
+# Store dates as real datetimes and amounts as numbers, so the analytics date range
+# scans and the typed (Arrow) loader can read them
+def normalize_expense(expense):
+    if "date" in expense:
+        parsed = pd.to_datetime(expense["date"], errors="coerce")
+        if not pd.isna(parsed):
+            expense["date"] = parsed.to_pydatetime()
+    if "amount" in expense:
+        amount = pd.to_numeric(expense["amount"], errors="coerce")
+        if not pd.isna(amount):
+            expense["amount"] = float(amount)
+    return expense
+
+
 # 🚀 ADD EXPENSE
 @app.post("/expenses")
 def add_expense(expense: dict):
     if "email" not in expense:
         raise HTTPException(status_code=400, detail="Missing user email")
 
+    normalize_expense(expense)
+    anomaly = spending_stats.check_transaction(expense)
+
     result = collection.insert_one(expense)
+    spending_stats.record_insert(expense)
     expense["_id"] = str(result.inserted_id)
-    return {"message": "Added", "id": str(result.inserted_id), "expense": expense}
+    expenses_changed(expense["email"], "add_expense")
+    return {"message": "Added", "id": str(result.inserted_id), "expense": expense, "anomaly": anomaly}
 
 
 # ✏️ UPDATE EXPENSE
@@ -317,21 +367,261 @@ def update_expense(id: str, expense: dict):
     if "email" not in expense:
         raise HTTPException(status_code=400, detail="Missing user email")
 
-    result = collection.update_one({"_id": ObjectId(id), "email": expense["email"]}, {"$set": expense})
-    if result.matched_count == 0:
+    normalize_expense(expense)
+
+    old = collection.find_one_and_update(
+        {"_id": ObjectId(id), "email": expense["email"]},
+        {"$set": expense},
+        return_document=ReturnDocument.BEFORE
+    )
+    if old is None:
         raise HTTPException(status_code=404, detail="Expense not found or not owned by user")
+    spending_stats.record_update(old, {**old, **expense})
+    expenses_changed(expense["email"], "update_expense")
     return {"message": "Updated"}
 
 
 # ❌ DELETE EXPENSE
 @app.delete("/expenses/{id}")
 def delete_expense(id: str, email: str = Query(...)):
-    result = collection.delete_one({"_id": ObjectId(id), "email": email})
-    if result.deleted_count == 0:
+    old = collection.find_one_and_delete({"_id": ObjectId(id), "email": email})
+    if old is None:
         raise HTTPException(status_code=404, detail="Expense not found or not owned by user")
+    spending_stats.record_delete(old)
+    expenses_changed(email, "delete_expense")
     return {"message": "Deleted"}
 
 
+# 📦 BULK ADD / UPDATE / DELETE
+# Body: {"email": ..., "insert": [expense, ...], "update": [{"id": ..., <fields>}, ...], "delete": [id, ...]}
+# Everything goes to Mongo as one unordered bulk_write; results come back per item.
+MAX_BULK_ITEMS = 1000
+
+
+@app.post("/expenses/bulk")
+def bulk_expenses(payload: dict):
+    email = payload.get("email")
+    if not email:
+        raise HTTPException(status_code=400, detail="Missing user email")
+
+    inserts = payload.get("insert", [])
+    updates = payload.get("update", [])
+    deletes = payload.get("delete", [])
+    for name, items in (("insert", inserts), ("update", updates), ("delete", deletes)):
+        if not isinstance(items, list):
+            raise HTTPException(status_code=400, detail=f"'{name}' must be a list")
+    if len(inserts) + len(updates) + len(deletes) > MAX_BULK_ITEMS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BULK_ITEMS} items per request")
+
+    results = []
+    ops = []
+    op_results = []  # result entry for each op, same order as `ops`
+    op_stats = []    # (old doc, new doc) for each op, to keep spending_stats in step
+    new_docs = []    # (result entry, doc) per insert, for the anomaly check
+
+    def parse_id(raw):
+        try:
+            return ObjectId(raw)
+        except (InvalidId, TypeError):
+            return None
+
+    for i, expense in enumerate(inserts):
+        if not isinstance(expense, dict):
+            results.append({"op": "insert", "index": i, "status": "invalid_item"})
+            continue
+        doc = {k: v for k, v in expense.items() if k not in ("_id", "id")}
+        doc["email"] = email
+        doc["_id"] = ObjectId()
+        normalize_expense(doc)
+        entry = {"op": "insert", "index": i, "id": str(doc["_id"]), "status": "ok"}
+        results.append(entry)
+        ops.append(InsertOne(doc))
+        op_results.append(entry)
+        op_stats.append((None, doc))
+        new_docs.append((entry, doc))
+
+    update_ids = [(i, item, parse_id(item.get("id")) if isinstance(item, dict) else None) for i, item in enumerate(updates)]
+    delete_ids = [(i, raw, parse_id(raw)) for i, raw in enumerate(deletes)]
+
+    # Ownership check up front, so unknown/foreign ids get a per-item "not_found"
+    # (the old docs are also needed to take them back out of spending_stats)
+    wanted = list({oid for _, _, oid in update_ids + delete_ids if oid is not None})
+    owned = {}
+    if wanted:
+        owned = {d["_id"]: d for d in collection.find({"_id": {"$in": wanted}, "email": email})}
+
+    # Only the first update/delete per id is applied; later ones would act on a stale snapshot
+    seen = set()
+
+    for i, item, oid in update_ids:
+        if not isinstance(item, dict):
+            results.append({"op": "update", "index": i, "status": "invalid_item"})
+            continue
+        entry = {"op": "update", "index": i, "id": item.get("id")}
+        results.append(entry)
+        if oid is None:
+            entry["status"] = "invalid_id"
+            continue
+        if oid not in owned:
+            entry["status"] = "not_found"
+            continue
+        if oid in seen:
+            entry["status"] = "duplicate"
+            continue
+        fields = {k: v for k, v in item.items() if k not in ("_id", "id", "email")}
+        if not fields:
+            entry["status"] = "no_changes"
+            continue
+        seen.add(oid)
+        normalize_expense(fields)
+        entry["status"] = "ok"
+        ops.append(UpdateOne({"_id": oid, "email": email}, {"$set": fields}))
+        op_results.append(entry)
+        op_stats.append((owned[oid], {**owned[oid], **fields}))
+
+    for i, raw, oid in delete_ids:
+        entry = {"op": "delete", "index": i, "id": raw}
+        results.append(entry)
+        if oid is None:
+            entry["status"] = "invalid_id"
+            continue
+        if oid not in owned:
+            entry["status"] = "not_found"
+            continue
+        if oid in seen:
+            entry["status"] = "duplicate"
+            continue
+        seen.add(oid)
+        entry["status"] = "ok"
+        ops.append(DeleteOne({"_id": oid, "email": email}))
+        op_results.append(entry)
+        op_stats.append((owned[oid], None))
+
+    # Checked against the stats from before this batch
+    for (entry, _), flag in zip(new_docs, spending_stats.check_transactions([doc for _, doc in new_docs])):
+        entry["anomaly"] = flag
+
+    counts = {"inserted": 0, "updated": 0, "deleted": 0}
+    if ops:
+        try:
+            result = collection.bulk_write(ops, ordered=False)
+            details = result.bulk_api_result
+        except BulkWriteError as e:
+            details = e.details
+            for err in details.get("writeErrors", []):
+                entry = op_results[err["index"]]
+                entry["status"] = "error"
+                entry["error"] = err.get("errmsg")
+        counts = {
+            "inserted": details.get("nInserted", 0),
+            "updated": details.get("nMatched", 0),
+            "deleted": details.get("nRemoved", 0),
+        }
+        changes = []
+        for entry, (old, new) in zip(op_results, op_stats):
+            if entry["status"] != "ok":
+                continue
+            if old is not None:
+                changes.append((old, -1))
+            if new is not None:
+                changes.append((new, 1))
+        spending_stats.record_changes(changes)
+        if any(counts.values()):
+            expenses_changed(email, "bulk_expenses")
+
+    return {"message": "Bulk operation complete", **counts, "results": results}
+
+
+# 📤 EXPORT EXPENSES (Parquet / Arrow IPC for the data team)
+EXPORT_BATCH_ROWS = 50000
+EXPORT_FORMATS = {
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+class _ChunkSink:
+    """Write-only file object that hands back whatever was written since the last drain."""
+
+    def __init__(self):
+        self.buffer = io.BytesIO()
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def drain(self):
+        data = self.buffer.getvalue()
+        self.buffer = io.BytesIO()
+        return data
+
+
+def export_schema():
+    return pa.schema(list(analytics.EXPENSE_FIELDS.items()))
+
+
+def iter_expense_batches(email):
+    """User's expenses as Arrow tables of EXPORT_BATCH_ROWS, paged by _id so memory stays flat."""
+    last_id = None
+    while True:
+        query = {"email": email}
+        if last_id is not None:
+            query["_id"] = {"$gt": last_id}
+        table = find_arrow_all(collection, query, schema=analytics.EXPENSE_SCHEMA, sort=[("_id", 1)], limit=EXPORT_BATCH_ROWS)
+        if table.num_rows == 0:
+            return
+        last_id = table.column("_id")[-1].as_py()
+        if analytics.has_untyped_values(table):
+            # Legacy string dates/amounts: parse just those rows instead of exporting nulls
+            df = analytics.expenses_frame(table)
+            yield pa.Table.from_pandas(df, preserve_index=False).cast(export_schema(), safe=False)
+        else:
+            yield table.drop(["_id"])
+        if table.num_rows < EXPORT_BATCH_ROWS:
+            return
+
+
+@app.get("/expenses/export")
+def export_expenses(email: str = Query(...), format: str = Query("parquet")):
+    if format not in EXPORT_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Format must be one of: {', '.join(EXPORT_FORMATS)}")
+    media_type, extension = EXPORT_FORMATS[format]
+    arrow_schema = export_schema()
+
+    def stream():
+        sink = _ChunkSink()
+        if format == "parquet":
+            writer = pq.ParquetWriter(sink, arrow_schema)
+        else:
+            writer = pa.ipc.new_stream(sink, arrow_schema)
+        for table in iter_expense_batches(email):
+            writer.write_table(table)
+            yield sink.drain()
+        writer.close()
+        yield sink.drain()
+
+    return StreamingResponse(
+        stream(),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="expenses.{extension}"'},
+    )
+
+
 # 📥 GET ALL EXPENSES (for viewing/updating UI)
 
 
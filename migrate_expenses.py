@@ -0,0 +1,77 @@
+"""
+One-off migration: convert legacy string `date` / `amount` fields on expenses to
+real Dates and doubles.
+
+Before the analytics date-range filtering, /expenses stored the request JSON as-is,
+so expenses added from the UI have dates like "2025-03-14" (and sometimes string
+amounts). Bounded `$gte/$lt` range queries never match strings, and the typed
+(Arrow) loader has to fall back to slow parsing for them, so run this once after deploying:
+
+    python migrate_expenses.py
+
+Safe to re-run; values that can't be parsed are left untouched and counted.
+"""
+import os
+import pandas as pd
+from pymongo import MongoClient, UpdateOne
+import certifi
+from dotenv import load_dotenv
+
+
+load_dotenv()  # Load from .env file
+
+MONGO_URI = os.getenv("MONGO_URI")
+
+client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
+db = client["expense_tracker"]
+collection = db["expenses"]
+
+BATCH_SIZE = 1000
+
+
+def _flush(ops):
+    if ops:
+        collection.bulk_write(ops, ordered=False)
+    return []
+
+
+def _migrate_field(field, parse):
+    converted = skipped = 0
+    ops = []
+    for doc in collection.find({field: {"$type": "string"}}, {field: 1}):
+        parsed = parse(doc[field])
+        if parsed is None:
+            skipped += 1
+            continue
+        ops.append(UpdateOne({"_id": doc["_id"], field: doc[field]}, {"$set": {field: parsed}}))
+        converted += 1
+        if len(ops) >= BATCH_SIZE:
+            ops = _flush(ops)
+    _flush(ops)
+    return converted, skipped
+
+
+# Same parsing the old analytics loader used
+def _parse_date(value):
+    parsed = pd.to_datetime(value, errors="coerce")
+    return None if pd.isna(parsed) else parsed.to_pydatetime()
+
+
+def _parse_amount(value):
+    parsed = pd.to_numeric(value, errors="coerce")
+    return None if pd.isna(parsed) else float(parsed)
+
+
+def migrate_dates():
+    return _migrate_field("date", _parse_date)
+
+
+def migrate_amounts():
+    return _migrate_field("amount", _parse_amount)
+
+
+if __name__ == "__main__":
+    converted, skipped = migrate_dates()
+    print(f"✅ Dates converted: {converted}, unparseable (left as is): {skipped}")
+    converted, skipped = migrate_amounts()
+    print(f"✅ Amounts converted: {converted}, unparseable (left as is): {skipped}")
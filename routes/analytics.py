@@ -1,9 +1,17 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Query, HTTPException
+from typing import Optional
+from datetime import datetime, timedelta
 import pandas as pd
+import numpy as np
+import pyarrow as pa
 import os
 from pymongo import MongoClient
 import certifi
 from dotenv import load_dotenv
+from pymongoarrow.api import Schema, find_arrow_all
+from pymongoarrow.types import ObjectIdType
+import spending_stats
+import forecasting
 
 
 load_dotenv()  # Load from .env file
@@ -14,18 +22,129 @@ client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
 db = client["expense_tracker"]
 collection = db["expenses"]
 
-def get_expenses_df(email: str):
-    data = list(collection.find({"email": email}))
-
-    if not data:
-        return pd.DataFrame()
-    
-    df = pd.DataFrame(data)
-    
-    # Normalize/clean
-    df["date"] = pd.to_datetime(df["date"], errors="coerce")
-    df["amount"] = pd.to_numeric(df["amount"], errors="coerce")
-    df["category"] = df.get("category", "Other")
+# Compound index so per-user date range scans don't touch the whole collection
+collection.create_index([("email", 1), ("date", 1)])
+# Lets the export page through a user's history by _id without sorting in memory
+collection.create_index([("email", 1), ("_id", 1)])
+
+# Only the fields the analytics actually read
+EXPENSE_PROJECTION = {"_id": 0, "date": 1, "description": 1, "amount": 1, "category": 1}
+
+# Fixed column types, so Mongo results decode straight into Arrow arrays (no per-row dicts).
+# Values of the wrong BSON type (e.g. a legacy string date/amount) come through as null;
+# expenses_frame re-reads just those rows by _id and parses them like the old loader.
+EXPENSE_FIELDS = {
+    "date": pa.timestamp("ms"),
+    "description": pa.string(),
+    "amount": pa.float64(),
+    "category": pa.string(),
+}
+EXPENSE_SCHEMA = Schema({"_id": ObjectIdType(), **EXPENSE_FIELDS})
+
+
+def month_start(dt, months_back=0):
+    """First day of the month `months_back` months before `dt`."""
+    return (pd.Timestamp(dt).to_period("M") - months_back).to_timestamp()
+
+
+def latest_expense_date(email: str, before=None):
+    date_filter = {"$type": "date"}
+    if before is not None:
+        date_filter["$lt"] = pd.Timestamp(before).to_pydatetime()
+    latest = collection.find_one(
+        {"email": email, "date": date_filter},
+        {"_id": 0, "date": 1},
+        sort=[("date", -1)]
+    )
+    return latest["date"] if latest else None
+
+
+def resolve_date_range(email: str, date_from=None, date_to=None, months=None, default_months=None):
+    """
+    Work out the (start, end) window for a request.
+    - `from` / `to` win if given (`to` is inclusive of the whole day)
+    - `months` = last N calendar months ending at `to` (or today); can't be combined with `from`
+    - otherwise the endpoint's own default window, counted back from the user's latest expense
+      (the latest one before `to`, if given)
+    Either bound can be None (open ended).
+    """
+    if date_from and months:
+        raise HTTPException(status_code=400, detail="Use either 'from' or 'months', not both")
+
+    start = end = None
+    if date_from:
+        start = pd.to_datetime(date_from, errors="coerce")
+        if pd.isna(start):
+            raise HTTPException(status_code=400, detail=f"Invalid 'from' date: {date_from}")
+    if date_to:
+        end = pd.to_datetime(date_to, errors="coerce")
+        if pd.isna(end):
+            raise HTTPException(status_code=400, detail=f"Invalid 'to' date: {date_to}")
+        end = end.normalize() + pd.Timedelta(days=1)
+
+    if start is None:
+        if months:
+            anchor = end - pd.Timedelta(days=1) if end is not None else datetime.now()
+            start = month_start(anchor, months - 1)
+        elif default_months:
+            latest = latest_expense_date(email, before=end)
+            if latest is not None:
+                start = month_start(latest, default_months - 1)
+
+    return start, end
+
+
+def expenses_query(email: str, start=None, end=None):
+    query = {"email": email}
+    date_filter = {}
+    if start is not None:
+        date_filter["$gte"] = pd.Timestamp(start).to_pydatetime()
+    if end is not None:
+        date_filter["$lt"] = pd.Timestamp(end).to_pydatetime()
+    if date_filter:
+        query["date"] = date_filter
+    return query
+
+
+def get_expenses_table(email: str, start=None, end=None):
+    return find_arrow_all(collection, expenses_query(email, start, end), schema=EXPENSE_SCHEMA)
+
+
+def has_untyped_values(table):
+    return table.column("date").null_count > 0 or table.column("amount").null_count > 0
+
+
+def _coerce(values, parse):
+    return parse(pd.Series(values, dtype=object), errors="coerce")
+
+
+def expenses_frame(table):
+    """
+    DataFrame (date, description, amount, category) from a table loaded with EXPENSE_SCHEMA.
+    Rows whose date/amount came through null are re-fetched by _id and parsed; a field
+    that's really missing (or unparseable) stays null.
+    """
+    df = table.drop(["_id"]).to_pandas()
+    untyped = np.flatnonzero((df["date"].isna() | df["amount"].isna()).to_numpy())
+    if len(untyped):
+        ids = table.column("_id").to_pylist()
+        positions = {ids[i]: i for i in untyped}
+        docs = list(collection.find({"_id": {"$in": list(positions)}}, {"date": 1, "amount": 1}))
+        rows = [positions[d["_id"]] for d in docs]
+        df.loc[rows, "date"] = _coerce([d.get("date") for d in docs], pd.to_datetime).to_numpy()
+        df.loc[rows, "amount"] = _coerce([d.get("amount") for d in docs], pd.to_numeric).to_numpy()
+    return df
+
+
+def get_expenses_df(email: str, start=None, end=None):
+    table = get_expenses_table(email, start, end)
+
+    if table.num_rows == 0:
+        return pd.DataFrame(columns=["Date", "Description", "Amount", "Category"])
+
+    # Columns arrive already typed (datetime64 / float64); only legacy rows need parsing
+    df = expenses_frame(table)
+    df["category"] = df["category"].fillna("Other")
     df = df.rename(columns={
         "date": "Date",
         "description": "Description",
@@ -38,8 +157,13 @@ def get_expenses_df(email: str):
 router = APIRouter()
 
 @router.get("/analytics/category-breakdown")
-def category_breakdown(email: str):
-    df = get_expenses_df(email)
+def category_breakdown(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months))
     
     # Ensure Amount is numeric
     df["Amount"] = pd.to_numeric(df["Amount"], errors='coerce')
@@ -50,11 +174,16 @@ def category_breakdown(email: str):
     return [{"name": row["Category"], "value": round(row["Amount"], 2)} for _, row in grouped.iterrows()]
 
 @router.get("/analytics/weekday-vs-weekend")
-def weekday_vs_weekend(email: str):
+def weekday_vs_weekend(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
     import pandas as pd
 
     # Load the data
-    df = get_expenses_df(email)
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months))
 
     # 🧹 Clean the data
     df = df.dropna(subset=["Date", "Amount"])
@@ -85,48 +214,38 @@ def weekday_vs_weekend(email: str):
 
 
 @router.get("/analytics/predictions")
-def predictions(email: str):
-    df = get_expenses_df(email)
+def predictions(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    # ⚡ Default view comes straight from the precomputed forecasts (see forecasting.py)
+    explicit_range = bool(date_from or date_to or months)
+    version = None
+    if not explicit_range:
+        stored, version = forecasting.get_forecast(email)
+        if stored is not None:
+            return stored
+
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months, default_months=forecasting.FORECAST_MONTHS))
     df["Date"] = pd.to_datetime(df["Date"], dayfirst=True, errors='coerce')
-    df = df.dropna(subset=["Date"])
-
     df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce")
-    df = df.dropna(subset=["Amount"])
-    df = df[df["Amount"] > 0]  # ✅ Filter out negative/zero
-
-
-    df["Month"] = df["Date"].dt.to_period("M").astype(str)
-
-    last_months = sorted(df["Month"].unique())
-    print("🗓️ Months found:", last_months)
-
-    if len(last_months) < 2:
-        return []
-
-    df_filtered = df[df["Month"].isin(last_months[-2:])]
-    pivot = df_filtered.pivot_table(index="Category", columns="Month", values="Amount", aggfunc="sum", fill_value=0)
-
-    # 💡 Ensure all values are float (even if they were accidentally strings)
-    pivot = pivot.astype(float)
 
-    print("📊 Pivot Table:\n", pivot)
-
-    pivot["Predicted"] = pivot.iloc[:, -1] + (pivot.iloc[:, -1] - pivot.iloc[:, -2])
-    pivot["Actual"] = pivot.iloc[:, -1]
-
-    return [
-        {
-            "category": idx,
-            "actual": row["Actual"],
-            "predicted": row["Predicted"]
-        }
-        for idx, row in pivot.iterrows()
-    ]
+    result = forecasting.forecast_from_df(df)
+    if not explicit_range:
+        forecasting.store_forecast(email, result, version)
+    return result
 
 
 @router.get("/analytics/biggest-category")
-def biggest_category(email: str):
-    df = get_expenses_df(email)
+def biggest_category(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months))
     df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce")
     df = df.dropna(subset=["Amount"])
     top = df.groupby("Category")["Amount"].sum().sort_values(ascending=False).head(1)
@@ -134,8 +253,13 @@ def biggest_category(email: str):
 
 
 @router.get("/analytics/weekly-trend")
-def weekly_trend(email: str):
-    df = get_expenses_df(email)  # 🔁 Pull only this user's data from MongoDB
+def weekly_trend(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months))  # 🔁 Pull only this user's data from MongoDB
 
     df["Date"] = pd.to_datetime(df["Date"], errors="coerce")
     df["Amount"] = pd.to_numeric(df["Amount"], errors="coerce")
@@ -151,8 +275,45 @@ def weekly_trend(email: str):
     ]
 
 @router.get("/analytics/spending-spike")
-def spending_spike(email: str):
-    df = get_expenses_df(email)
+def spending_spike(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    # ⚡ No explicit range: the daily totals are kept up to date on every write, so it's one lookup
+    if not (date_from or date_to or months):
+        spike = spending_stats.latest_month_spike(email)
+        if spike:
+            day = spike["day"]
+            # Same docs the daily totals counted: legacy string dates too, unparseable amounts never
+            spike_docs = collection.find(
+                {"email": email, "$or": [
+                    {"date": {"$gte": day, "$lt": day + timedelta(days=1)}},
+                    {"date": {"$type": "string"}},
+                ]},
+                {**EXPENSE_PROJECTION, "email": 1}
+            )
+            items = []
+            for doc in spike_docs:
+                parsed = spending_stats.counted(doc)
+                if parsed is None or parsed[2] != day:
+                    continue
+                items.append({
+                    "description": doc.get("description"),
+                    "amount": round(parsed[3], 2),
+                    "category": parsed[1]
+                })
+            return {
+                "spike_date": day.strftime("%Y-%m-%d"),
+                "total_amount": round(spike["total"], 2),
+                "z_score": spike["z_score"],
+                "is_anomaly": spike["is_anomaly"],
+                "items": items
+            }
+
+    # Only the latest month matters here
+    df = get_expenses_df(email, *resolve_date_range(email, date_from, date_to, months, default_months=1))
     
     # 🧹 Clean the data
     df["Date"] = pd.to_datetime(df["Date"], errors="coerce", dayfirst=True)
@@ -188,9 +349,14 @@ def spending_spike(email: str):
         for _, row in spike_items.iterrows()
     ]
 
+    # Same yardstick as the fast path: the user's usual daily spending
+    z, is_anomaly = spending_stats.day_score(email, float(spike_amount))
+
     return {
         "spike_date": spike_date.strftime("%Y-%m-%d"),
         "total_amount": round(spike_amount, 2),
+        "z_score": z,
+        "is_anomaly": is_anomaly,
         "items": items
     }
 
@@ -216,20 +382,27 @@ def summarize_expense_insights(analytics):
             summaries.append(f"{pred['category']} overspending predicted")
 
     # Rule 4: Spending spike
+    # Only call it a spike if it stands out from the user's usual days
     spike = analytics.get("spending_spike")
-    if spike:
+    if spike and spike.get("spike_date") and spike.get("is_anomaly"):
         day = spike["spike_date"]
         summaries.append(f"Spending spike on {day}")
 
     return summaries[:3]  # Max 3 phrases (short)
 
 @router.get("/analytics/summary")
-def summary(email: str):
+def summary(
+    email: str,
+    date_from: Optional[str] = Query(None, alias="from"),
+    date_to: Optional[str] = Query(None, alias="to"),
+    months: Optional[int] = Query(None, ge=1)
+):
+    # Pass the range through explicitly (the Query() defaults only apply over HTTP)
     all_data = {
-        "biggest_category": biggest_category(email),
-        "weekday_vs_weekend": weekday_vs_weekend(email),
-        "predictions": predictions(email),
-        "spending_spike": spending_spike(email)
+        "biggest_category": biggest_category(email, date_from, date_to, months),
+        "weekday_vs_weekend": weekday_vs_weekend(email, date_from, date_to, months),
+        "predictions": predictions(email, date_from, date_to, months),
+        "spending_spike": spending_spike(email, date_from, date_to, months)
     }
 
     phrases = summarize_expense_insights(all_data)
@@ -238,3 +411,9 @@ def summary(email: str):
         "summary_phrases": phrases,
         "raw_analytics": all_data
     }
+
+
+@router.post("/analytics/rebuild-stats")
+def rebuild_stats(email: str):
+    count = spending_stats.rebuild_user_stats(email)
+    return {"message": f"Spending stats rebuilt from {count} expenses."}
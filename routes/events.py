@@ -0,0 +1,234 @@
+from fastapi import APIRouter, Query
+from fastapi.responses import StreamingResponse
+from fastapi.encoders import jsonable_encoder
+from starlette.concurrency import run_in_threadpool
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from pymongo import MongoClient
+from pymongo.errors import OperationFailure
+import certifi
+from dotenv import load_dotenv
+
+from routes import analytics
+
+
+load_dotenv()  # Load from .env file
+
+# "local" = single process (dev / one worker), "mongo" = fan out across workers via a change stream
+EVENTS_BACKEND = os.getenv("EVENTS_BACKEND", "local")
+KEEPALIVE_SECONDS = 15
+WATCH_RETRY_SECONDS = 2
+
+
+class LocalBackend:
+    """In-process stand-in: events only reach subscribers in this worker."""
+
+    def start(self, deliver):
+        self.deliver = deliver
+
+    def publish(self, email, event):
+        self.deliver(email, event)
+
+
+class MongoBackend:
+    """
+    Cross-worker backend. Events are written to a collection and every worker
+    tails it with a change stream (needs a replica set, which Atlas always is).
+    """
+
+    def __init__(self, uri):
+        client = MongoClient(uri, tlsCAFile=certifi.where())
+        self.events = client["expense_tracker"]["analytics_events"]
+        # Events are only useful for a moment; let Mongo clean them up
+        self.events.create_index("created_at", expireAfterSeconds=300)
+
+    def start(self, deliver):
+        def watch():
+            resume_token = None
+            while True:
+                try:
+                    with self.events.watch(
+                        [{"$match": {"operationType": "insert"}}],
+                        resume_after=resume_token
+                    ) as stream:
+                        for change in stream:
+                            resume_token = change["_id"]
+                            doc = change["fullDocument"]
+                            deliver(doc["email"], doc["event"])
+                except OperationFailure as e:
+                    # e.g. ChangeStreamHistoryLost: the token has aged out of the oplog, so
+                    # resuming from it can never work; start again from "now"
+                    if not e.has_error_label("ResumableChangeStreamError"):
+                        resume_token = None
+                    print("❌ Event change stream failed, retrying:", str(e))
+                    time.sleep(WATCH_RETRY_SECONDS)
+                except Exception as e:
+                    # Network blips / elections: pick up where we left off rather than going quiet
+                    print("❌ Event change stream failed, retrying:", str(e))
+                    time.sleep(WATCH_RETRY_SECONDS)
+
+        threading.Thread(target=watch, daemon=True).start()
+
+    def publish(self, email, event):
+        self.events.insert_one({"email": email, "event": event, "created_at": datetime.utcnow()})
+
+
+class AnalyticsBroker:
+    """
+    Keeps one asyncio queue per open stream, grouped by user email.
+    `publish` is safe to call from sync routes (threadpool) and async ones.
+
+    On a change event the user's snapshot is recomputed once, in a background
+    thread, and the result is fanned out to all of that user's streams. Events
+    arriving mid-recompute just trigger one more pass afterwards.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.subscribers = {}  # email -> set of (loop, queue)
+        self.latest = {}       # email -> last snapshot, while anyone is subscribed
+        self.computing = set()
+        self.dirty = set()
+        self.lock = threading.Lock()
+        backend.start(self._deliver)
+
+    def subscribe(self, email):
+        entry = (asyncio.get_running_loop(), asyncio.Queue())
+        with self.lock:
+            self.subscribers.setdefault(email, set()).add(entry)
+        return entry
+
+    def unsubscribe(self, email, entry):
+        with self.lock:
+            subs = self.subscribers.get(email)
+            if subs:
+                subs.discard(entry)
+                if not subs:
+                    del self.subscribers[email]
+                    self.latest.pop(email, None)
+
+    def current_snapshot(self, email):
+        """Latest snapshot shared by this user's streams, computed if nobody has one yet."""
+        with self.lock:
+            snapshot = self.latest.get(email)
+        if snapshot is None:
+            snapshot = compute_snapshot(email)
+            with self.lock:
+                if email in self.subscribers:
+                    self.latest.setdefault(email, snapshot)
+        return snapshot
+
+    def publish(self, email, event):
+        if not email:
+            return
+        try:
+            self.backend.publish(email, event)
+        except Exception as e:
+            # A missed push isn't worth failing the write that triggered it
+            print("❌ Event publish failed:", str(e))
+
+    def _deliver(self, email, event):
+        with self.lock:
+            if email not in self.subscribers:
+                return
+            if email in self.computing:
+                self.dirty.add(email)
+                return
+            self.computing.add(email)
+        threading.Thread(target=self._recompute, args=(email,), daemon=True).start()
+
+    def _recompute(self, email):
+        while True:
+            snapshot = compute_snapshot(email)
+            with self.lock:
+                if email in self.dirty:
+                    # More writes landed while computing; this one is already stale
+                    self.dirty.discard(email)
+                    continue
+                self.computing.discard(email)
+                subs = list(self.subscribers.get(email, ()))
+                if subs:
+                    self.latest[email] = snapshot
+            for loop, queue in subs:
+                loop.call_soon_threadsafe(queue.put_nowait, snapshot)
+            return
+
+
+if EVENTS_BACKEND == "mongo":
+    broker = AnalyticsBroker(MongoBackend(os.getenv("MONGO_URI")))
+else:
+    broker = AnalyticsBroker(LocalBackend())
+
+
+def compute_snapshot(email: str):
+    sections = {
+        "category_breakdown": lambda: analytics.category_breakdown(email, None, None, None),
+        "weekly_trend": lambda: analytics.weekly_trend(email, None, None, None),
+        "summary": lambda: analytics.summary(email, None, None, None),
+    }
+    snapshot = {}
+    for name, compute in sections.items():
+        try:
+            snapshot[name] = jsonable_encoder(compute())
+        except Exception as e:
+            snapshot[name] = {"error": str(e)}
+
+    # summary already computed this one; only fall back to running it alone if summary failed
+    raw = snapshot["summary"].get("raw_analytics") if isinstance(snapshot["summary"], dict) else None
+    if raw and "weekday_vs_weekend" in raw:
+        snapshot["weekday_vs_weekend"] = raw["weekday_vs_weekend"]
+    else:
+        try:
+            snapshot["weekday_vs_weekend"] = jsonable_encoder(analytics.weekday_vs_weekend(email, None, None, None))
+        except Exception as e:
+            snapshot["weekday_vs_weekend"] = {"error": str(e)}
+    return snapshot
+
+
+def sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+router = APIRouter()
+
+@router.get("/analytics/stream")
+async def analytics_stream(email: str = Query(...)):
+    """
+    Server-Sent Events feed for the dashboard. Sends a full snapshot on connect,
+    then only the sections that changed whenever this user's expenses change.
+    """
+    entry = broker.subscribe(email)
+    queue = entry[1]
+
+    async def stream():
+        try:
+            last = await run_in_threadpool(broker.current_snapshot, email)
+            yield sse("snapshot", last)
+
+            while True:
+                try:
+                    current = await asyncio.wait_for(queue.get(), timeout=KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+
+                # The broker computes snapshots once per user; only the newest one matters
+                while not queue.empty():
+                    current = queue.get_nowait()
+
+                delta = {k: v for k, v in current.items() if last.get(k) != v}
+                last = current
+                if delta:
+                    yield sse("update", delta)
+        finally:
+            broker.unsubscribe(email, entry)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -0,0 +1,420 @@
+"""
+Incremental spending statistics, kept up to date on every expense write.
+
+For each user we keep:
+- daily totals per category (plus an "__all__" row per day for the overall total)
+- running count / sum / sum of squares of those daily totals, per category
+- running count / sum / sum of squares of individual transaction amounts, per category
+
+Everything is adjusted with atomic $inc updates, so several workers can write
+at once. Mean and variance are O(1) reads, which makes spike and anomaly checks
+a single lookup instead of re-grouping the month's rows.
+
+Users with history from before this existed are rebuilt lazily on first touch;
+`python spending_stats.py` backfills everyone up front.
+"""
+import math
+import os
+import pandas as pd
+from pymongo import MongoClient, ReturnDocument, UpdateOne
+from bson.objectid import ObjectId
+import certifi
+from dotenv import load_dotenv
+
+
+load_dotenv()  # Load from .env file
+
+MONGO_URI = os.getenv("MONGO_URI")
+
+client = MongoClient(MONGO_URI, tlsCAFile=certifi.where())
+db = client["expense_tracker"]
+expenses = db["expenses"]
+daily_totals = db["daily_totals"]
+running_stats = db["spending_stats"]
+
+daily_totals.create_index([("email", 1), ("category", 1), ("day", 1)], unique=True)
+daily_totals.create_index([("email", 1), ("category", 1), ("month", 1), ("total", -1)])
+running_stats.create_index([("email", 1), ("category", 1), ("kind", 1)], unique=True)
+
+ALL = "__all__"
+ANOMALY_Z = 3.0     # a transaction this many std devs above its category mean is flagged
+SPIKE_Z = 2.0       # a day this many std devs above the user's daily mean is a real spike
+MIN_SAMPLES = 5     # don't judge anything until we've seen this many values
+CHUNK_SIZE = 500    # users per backfill query
+
+
+def _day(date):
+    parsed = pd.to_datetime(date, errors="coerce")
+    if pd.isna(parsed):
+        return None
+    return parsed.normalize().to_pydatetime()
+
+
+def _amount(value):
+    try:
+        amount = float(value)
+    except (TypeError, ValueError):
+        return None
+    return None if math.isnan(amount) else amount
+
+
+def ensure_user_stats(email):
+    """
+    Users with history from before these stats existed are rebuilt from scratch the
+    first time they're touched. Returns True if a rebuild happened (it already
+    includes any expense just written, so callers shouldn't apply it again).
+    """
+    if not email:
+        return False
+    if running_stats.find_one({"email": email, "category": ALL, "kind": "meta"}, {"_id": 1}):
+        return False
+    rebuild_user_stats(email)
+    return True
+
+
+def _bump(email, category, kind, n=0, s=0.0, sq=0.0):
+    running_stats.update_one(
+        {"email": email, "category": category, "kind": kind},
+        {"$inc": {"n": n, "sum": s, "sumsq": sq}},
+        upsert=True
+    )
+
+
+def _day_stats_delta(old_total, old_count, new_total, new_count):
+    """How one day's total moving from old to new changes the (n, sum, sumsq) of daily totals."""
+    if new_count <= 0:
+        if old_count > 0:
+            return -1, -old_total, -old_total ** 2
+        return 0, 0.0, 0.0
+    if old_count <= 0:
+        return 1, new_total, new_total ** 2
+    return 0, new_total - old_total, new_total ** 2 - old_total ** 2
+
+
+def _move_day(email, category, day, total_delta, count_delta):
+    """
+    Apply a change to one daily total atomically and return how the daily stats
+    (n, sum, sumsq) move. The BEFORE document tells us exactly what this write
+    changed, even with other writers on the same day.
+    """
+    before = daily_totals.find_one_and_update(
+        {"email": email, "category": category, "day": day},
+        {
+            "$inc": {"total": total_delta, "count": count_delta},
+            "$setOnInsert": {"month": day.strftime("%Y-%m")},
+        },
+        upsert=True,
+        return_document=ReturnDocument.BEFORE
+    )
+    old_total = before["total"] if before else 0.0
+    old_count = before["count"] if before else 0
+    new_total = old_total + total_delta
+    new_count = old_count + count_delta
+
+    if new_count <= 0:
+        # Last transaction of the day is gone, so the day leaves the sample
+        daily_totals.delete_one({"email": email, "category": category, "day": day, "count": {"$lte": 0}})
+    return _day_stats_delta(old_total, old_count, new_total, new_count)
+
+
+def _add_to_day(email, category, day, amount, sign):
+    """Move one transaction in/out of a daily total and keep the daily stats in step."""
+    n, ds, dsq = _move_day(email, category, day, sign * amount, sign)
+    if n or ds or dsq:
+        _bump(email, category, "daily", n, ds, dsq)
+
+
+def _parse(expense):
+    if not expense:
+        return None
+    email = expense.get("email")
+    day = _day(expense.get("date"))
+    amount = _amount(expense.get("amount"))
+    if not email or day is None or amount is None:
+        return None
+    return email, expense.get("category") or "Other", day, amount
+
+
+def counted(expense):
+    """(email, category, day, amount) as the stats count this expense, or None if they skip it."""
+    return _parse(expense)
+
+
+def _apply(expense, sign):
+    parsed = _parse(expense)
+    if parsed is None:
+        return
+    email, category, day, amount = parsed
+
+    _bump(email, category, "txn", sign, sign * amount, sign * amount ** 2)
+    _add_to_day(email, category, day, amount, sign)
+    _add_to_day(email, ALL, day, amount, sign)
+
+
+def record_insert(expense):
+    if not ensure_user_stats((expense or {}).get("email")):
+        _apply(expense, 1)
+
+
+def record_delete(expense):
+    if not ensure_user_stats((expense or {}).get("email")):
+        _apply(expense, -1)
+
+
+def record_update(old, new):
+    if not ensure_user_stats((old or {}).get("email")):
+        _apply(old, -1)
+        _apply(new, 1)
+
+
+def record_changes(changes):
+    """
+    Batch version of record_* for uploads and bulk edits: `changes` is a list of
+    (expense, +1 / -1). Rows are pre-aggregated per (category, day), so the cost is
+    one atomic update per distinct day touched (not per row), plus one bulk_write
+    for each stats collection.
+    """
+    rows = []
+    for expense, sign in changes:
+        parsed = _parse(expense)
+        if parsed is not None:
+            email, category, day, amount = parsed
+            rows.append({"email": email, "category": category, "day": day, "amount": amount, "sign": sign})
+    if not rows:
+        return
+
+    df = pd.DataFrame(rows)
+    rebuilt = {email for email in df["email"].unique() if ensure_user_stats(email)}
+    df = df[~df["email"].isin(rebuilt)]
+    if df.empty:
+        return
+
+    df["signed"] = df["sign"] * df["amount"]
+    df["signed_sq"] = df["sign"] * df["amount"] ** 2
+
+    txn = df.groupby(["email", "category"]).agg(n=("sign", "sum"), s=("signed", "sum"), sq=("signed_sq", "sum"))
+    running_stats.bulk_write([
+        UpdateOne(
+            {"email": email, "category": category, "kind": "txn"},
+            {"$inc": {"n": int(r["n"]), "sum": float(r["s"]), "sumsq": float(r["sq"])}},
+            upsert=True
+        )
+        for (email, category), r in txn.iterrows()
+    ], ordered=False)
+
+    days = pd.concat([df, df.assign(category=ALL)], ignore_index=True)
+    days = days.groupby(["email", "category", "day"]).agg(total=("signed", "sum"), count=("sign", "sum")).reset_index()
+    days = days[(days["total"] != 0) | (days["count"] != 0)]
+
+    stat_deltas = {}
+    for _, r in days.iterrows():
+        delta = _move_day(r["email"], r["category"], r["day"].to_pydatetime(), float(r["total"]), int(r["count"]))
+        acc = stat_deltas.setdefault((r["email"], r["category"]), [0, 0.0, 0.0])
+        for i in range(3):
+            acc[i] += delta[i]
+
+    stat_ops = [
+        UpdateOne(
+            {"email": email, "category": category, "kind": "daily"},
+            {"$inc": {"n": int(n), "sum": float(ds), "sumsq": float(dsq)}},
+            upsert=True
+        )
+        for (email, category), (n, ds, dsq) in stat_deltas.items()
+        if n or ds or dsq
+    ]
+    if stat_ops:
+        running_stats.bulk_write(stat_ops, ordered=False)
+
+
+def _mean_std(stats):
+    if not stats or stats.get("n", 0) < 1:
+        return None, None
+    n, s, sq = stats["n"], stats["sum"], stats["sumsq"]
+    mean = s / n
+    if n < 2:
+        return mean, None
+    var = max((sq - s * s / n) / (n - 1), 0.0)
+    return mean, math.sqrt(var)
+
+
+def _summary(stats):
+    mean, std = _mean_std(stats)
+    return {"n": stats["n"] if stats else 0, "mean": mean, "std": std}
+
+
+def get_stats(email, category=ALL, kind="daily"):
+    return _summary(running_stats.find_one({"email": email, "category": category, "kind": kind}))
+
+
+def z_score(value, stats):
+    if stats["n"] < MIN_SAMPLES or not stats["std"]:
+        return None
+    return (value - stats["mean"]) / stats["std"]
+
+
+def day_score(email, total):
+    """z-score of a day's total against the user's usual daily spending, and whether it's a spike."""
+    ensure_user_stats(email)
+    z = z_score(total, get_stats(email))
+    return (round(z, 2) if z is not None else None), (z is not None and z >= SPIKE_Z)
+
+
+def check_transactions(items):
+    """
+    Flag transactions that are unusually large for their category, checked against
+    the stats from before they were recorded. Returns one entry per item: None if it
+    looks normal. One stats query for the whole batch.
+    """
+    parsed = [(item.get("email"), item.get("category") or "Other", _amount(item.get("amount"))) for item in items]
+    emails = {email for email, _, amount in parsed if email and amount is not None}
+    if not emails:
+        return [None] * len(items)
+    for email in emails:
+        ensure_user_stats(email)
+
+    categories = {category for _, category, _ in parsed}
+    stats = {
+        (d["email"], d["category"]): _summary(d)
+        for d in running_stats.find({"email": {"$in": list(emails)}, "category": {"$in": list(categories)}, "kind": "txn"})
+    }
+
+    flags = []
+    for email, category, amount in parsed:
+        cat_stats = stats.get((email, category))
+        z = z_score(amount, cat_stats) if cat_stats and amount is not None else None
+        if z is None or z < ANOMALY_Z:
+            flags.append(None)
+            continue
+        flags.append({
+            "category": category,
+            "amount": round(amount, 2),
+            "category_average": round(cat_stats["mean"], 2),
+            "z_score": round(z, 2),
+        })
+    return flags
+
+
+def check_transaction(expense):
+    """Single-expense version of check_transactions."""
+    return check_transactions([expense])[0]
+
+
+def latest_month_spike(email):
+    """Highest-spending day in the user's latest month, from the precomputed daily totals."""
+    ensure_user_stats(email)
+    latest = daily_totals.find_one({"email": email, "category": ALL}, sort=[("day", -1)])
+    if not latest:
+        return None
+    top = daily_totals.find_one(
+        {"email": email, "category": ALL, "month": latest["month"]},
+        sort=[("total", -1)]
+    )
+    z, is_anomaly = day_score(email, top["total"])
+    return {
+        "day": top["day"],
+        "total": top["total"],
+        "z_score": z,
+        "is_anomaly": is_anomaly,
+    }
+
+
+def _build_docs(df):
+    """daily_totals and spending_stats documents from a frame of email/date/amount/category rows."""
+    df = df.copy()
+    df["day"] = pd.to_datetime(df["date"], errors="coerce").dt.normalize()
+    df["amount"] = pd.to_numeric(df["amount"], errors="coerce")
+    df["category"] = df["category"].fillna("Other") if "category" in df else "Other"
+    df = df.dropna(subset=["email", "day", "amount"])
+    if df.empty:
+        return [], []
+
+    sq = lambda a: (a ** 2).sum()
+    txn = df.groupby(["email", "category"])["amount"].agg(n="count", sum="sum", sumsq=sq)
+    per_cat = df.groupby(["email", "category", "day"])["amount"].agg(total="sum", count="count").reset_index()
+    per_all = df.groupby(["email", "day"])["amount"].agg(total="sum", count="count").reset_index()
+    per_all["category"] = ALL
+    days = pd.concat([per_cat, per_all], ignore_index=True)
+    daily = days.groupby(["email", "category"])["total"].agg(n="count", sum="sum", sumsq=sq)
+
+    day_docs = [
+        {
+            "email": row["email"],
+            "category": row["category"],
+            "day": row["day"].to_pydatetime(),
+            "month": row["day"].strftime("%Y-%m"),
+            "total": float(row["total"]),
+            "count": int(row["count"]),
+        }
+        for _, row in days.iterrows()
+    ]
+    stat_docs = [
+        {"email": email, "category": cat, "kind": kind, "n": int(r["n"]), "sum": float(r["sum"]), "sumsq": float(r["sumsq"])}
+        for kind, frame in (("txn", txn), ("daily", daily))
+        for (email, cat), r in frame.iterrows()
+    ]
+    return day_docs, stat_docs
+
+
+def _rebuild(emails):
+    """
+    Recompute everything for a set of users in one pass over their expenses.
+
+    Nothing is deleted up front: every rebuilt doc is upserted with absolute values
+    on its unique key (so a concurrent $inc upsert can't leave a one-transaction doc
+    behind), then leftovers from older builds are swept, and only then is the meta
+    doc written to mark the users as built.
+    """
+    build = ObjectId()
+    df = pd.DataFrame(list(expenses.find(
+        {"email": {"$in": emails}},
+        {"_id": 0, "email": 1, "date": 1, "amount": 1, "category": 1}
+    )))
+    day_docs, stat_docs = _build_docs(df) if not df.empty else ([], [])
+
+    if day_docs:
+        daily_totals.bulk_write([
+            UpdateOne(
+                {"email": d["email"], "category": d["category"], "day": d["day"]},
+                {"$set": {"month": d["month"], "total": d["total"], "count": d["count"], "build": build}},
+                upsert=True
+            )
+            for d in day_docs
+        ], ordered=False)
+    if stat_docs:
+        running_stats.bulk_write([
+            UpdateOne(
+                {"email": d["email"], "category": d["category"], "kind": d["kind"]},
+                {"$set": {"n": d["n"], "sum": d["sum"], "sumsq": d["sumsq"], "build": build}},
+                upsert=True
+            )
+            for d in stat_docs
+        ], ordered=False)
+
+    # Days / categories that no longer exist in the history
+    daily_totals.delete_many({"email": {"$in": emails}, "build": {"$ne": build}})
+    running_stats.delete_many({"email": {"$in": emails}, "kind": {"$ne": "meta"}, "build": {"$ne": build}})
+
+    # The meta doc marks the user as built, see ensure_user_stats
+    running_stats.bulk_write([
+        UpdateOne({"email": email, "category": ALL, "kind": "meta"}, {"$set": {"build": build}}, upsert=True)
+        for email in emails
+    ], ordered=False)
+    return len(df)
+
+
+def rebuild_user_stats(email):
+    """Recompute everything for one user from their expense history (backfill / repair)."""
+    return _rebuild([email])
+
+
+def backfill_all(chunk_size=CHUNK_SIZE):
+    """Build stats for every user, chunked by user like forecasting.precompute_all."""
+    emails = [e for e in expenses.distinct("email") if e]
+    for start in range(0, len(emails), chunk_size):
+        _rebuild(emails[start:start + chunk_size])
+        print(f"📊 Spending stats rebuilt for {min(start + chunk_size, len(emails))}/{len(emails)} users")
+    return len(emails)
+
+
+if __name__ == "__main__":
+    backfill_all()